@@ -1,110 +1,392 @@
+import re
+import ast
+import sys
 import sympy
-import random
 import string
-import time
-from bidict import bidict
-from sympy import sympify, Symbol
-from sympy.parsing.latex import parse_latex
-from sympy.printing.latex import latex_escape
-from sympy.parsing.sympy_parser import parse_expr
-from IPython.display import HTML, Javascript, display
+import functools
+import itertools
+import weakref
+from collections.abc import Hashable
+from types import MappingProxyType
+from sympy import Symbol, Basic, Pow
+from sympy.core.function import Application
+from sympy.core.operations import AssocOp
+from sympy.core.relational import Relational
+from sympy.matrices import MatrixBase
+
+
+_LIT_MAP = {r'\exponentialE': 'e', r'\differentialD': r'\d'}
+_RE_LIT = re.compile('|'.join(map(re.escape, _LIT_MAP)))
+
+
+@functools.lru_cache(maxsize=256)
+def _clean_latex_cached(latx):
+    return _RE_LIT.sub(lambda m: _LIT_MAP[m.group(0)], latx)
+
+
+_mf_counter = itertools.count()
+
+# Editor callbacks by identifier; weak so open editors don't keep parsers alive.
+_callbacks = {}
+# Kernel side of each editor's comm, closed together with its callback.
+_comms = {}
+
+
+def _release_editor(identifier):
+    _callbacks.pop(identifier, None)
+    comm = _comms.pop(identifier, None)
+    if comm is not None:
+        comm.close()
+
+
+def _open_comm(identifier):
+    # notebook-only dependencies, deliberately not in requirements.txt
+    try:
+        from comm import create_comm
+    except ImportError:    # ipykernel before the comm package split
+        from ipykernel.comm import Comm as create_comm
+    comm = _comms[identifier] = create_comm(target_name=_COMM_TARGET, data={'id': identifier})
+    return comm
+
+
+def _dispatch(identifier, latx):
+    callback = _callbacks.get(identifier)
+    handler = callback() if callback is not None else None
+    if handler is not None:
+        handler(latx)
+
+
+_parse_latex = None    # bound on first use, importing it bootstraps ANTLR
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_latex_cached(latx):
+    global _parse_latex
+    if _parse_latex is None:
+        from sympy.parsing.latex import parse_latex
+        _parse_latex = parse_latex
+    return _parse_latex(latx)
+
+
+def _intern_latex(latx):
+    # long strings are rarely repeated and would only bloat the intern table
+    return sys.intern(latx) if len(latx) < 1024 else latx
+
+
+@functools.lru_cache(maxsize=512)
+def _latex_for(expr, symbol_names):
+    return _intern_latex(sympy.latex(expr, symbol_names=dict(symbol_names)))
+
+
+# Names a saved srepr may refer to: SymPy classes and singletons such as pi or oo.
+_SREPR_NAMES = {n: v for n, v in vars(sympy).items() if not n.startswith('_') and (
+    isinstance(v, Basic) or isinstance(v, type) and issubclass(v, (Basic, MatrixBase)))}
+# Built with evaluate=False, so unevaluated parser output keeps its shape on reload.
+_SREPR_UNEVALUATED = (AssocOp, Pow, Application, Relational)
+# Constructors whose string arguments are names or numbers, others may sympify (eval) them.
+_SREPR_STR_ARGS = frozenset({'Symbol', 'Dummy', 'Function', 'Float', 'Str'})
+
+
+def _from_srepr(text):
+    """Rebuild an expression from ``sympy.srepr`` output without evaluating it.
+
+    Saved files are untrusted input, ``sympify`` would run any code found in them.
+    """
+    return _build_srepr(ast.parse(text, mode='eval').body)
+
+
+def _find_subclass(bases, name):
+    seen, todo = set(), list(bases)
+    while todo:
+        cls = todo.pop()
+        if cls.__name__ == name:
+            return cls
+        for sub in type.__subclasses__(cls):
+            if sub not in seen:
+                seen.add(sub)
+                todo.append(sub)
+    return None
+
+
+def _build_srepr(node, str_ok=False):
+    if isinstance(node, ast.Constant) and (str_ok or not isinstance(node.value, str)):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_build_srepr(node.operand)    # literals and singletons such as -oo
+    if isinstance(node, ast.Tuple):
+        return tuple(_build_srepr(e) for e in node.elts)
+    if isinstance(node, ast.List):
+        return [_build_srepr(e) for e in node.elts]
+    if isinstance(node, ast.Name) and node.id in _SREPR_NAMES:
+        return _SREPR_NAMES[node.id]
+    if isinstance(node, ast.Name):
+        # srepr also names classes SymPy doesn't export, e.g. ExprCondPair
+        found = _find_subclass((Basic, MatrixBase), node.id)
+        if found is not None:
+            return found
+    if isinstance(node, ast.Call) and all(k.arg is not None for k in node.keywords):
+        str_ok = isinstance(node.func, ast.Name) and node.func.id in _SREPR_STR_ARGS
+        func = _build_srepr(node.func)
+        kwargs = {k.arg: _build_srepr(k.value, str_ok) for k in node.keywords}
+        if isinstance(func, type) and issubclass(func, _SREPR_UNEVALUATED):
+            kwargs.setdefault('evaluate', False)
+        return func(*(_build_srepr(a, str_ok) for a in node.args), **kwargs)
+    raise ValueError(f"unsupported expression in saved formula: {ast.unparse(node)}")
+
+
+# Loads MathLive once per page; every editor awaits the same promise.
+_MATHLIVE_LOADER_JS = """
+        if (window.__mfLoader == undefined){
+            window.__mfLoader = import('https://unpkg.com/mathlive?module').then((mathlive) => {
+                // Create Keyboard
+                mathlive.makeSharedVirtualKeyboard({
+                  virtualKeyboardLayout: 'dvorak',
+                });
+                window.mathlive = mathlive;
+                IPython.notebook.kernel.execute("matlive_loaded=True");
+                return mathlive;
+            });
+
+            var link = document.createElement('link');
+            link.type = 'text/css';
+            link.rel = 'stylesheet';
+            link.href = 'https://unpkg.com/mathlive/dist/mathlive-static.css';
+            document.head.appendChild(link);
+
+            var style = document.createElement('style')
+            style.innerHTML = ".formula{ font-size: 1.728em }";
+            document.head.appendChild(style);
+        }
+"""
+
+_COMM_TARGET = "easymath_mathfield"
+
+# Classic script so the comm target is registered before the kernel opens the comm.
+_COMM_TARGET_JS = """
+        (function(){
+            var cm = IPython.notebook.kernel.comm_manager;
+            if (cm.targets['""" + _COMM_TARGET + """'] == undefined){
+                cm.register_target('""" + _COMM_TARGET + """', (comm, msg) => {
+                    var id = msg.content.data.id;
+                    comm.on_msg((m) => {
+                        var mf = document.getElementById('formula_' + id);
+                        if (mf && mf.value !== m.content.data.value){
+                            mf.setValue(m.content.data.value, {suppressChangeNotifications: true});
+                        }
+                    });
+                });
+            }
+        })();
+"""
+
+_EDITOR_TEMPLATE = string.Template("""
+    <label>Math-Editor</label>
+    <math-field use-shared-virtual-keyboard id="formula_$identifier" class="formula">
+        $initial_latex
+    </math-field>
+    <script>""" + _COMM_TARGET_JS + """    </script>
+    <script type="module">""" + _MATHLIVE_LOADER_JS + """
+        window.__mfLoader.then((mathlive) => {
+            console.log("Matlive observer $identifier started!")
+            mathlive.renderMathInDocument()
+            var mf = document.getElementById('formula_$identifier');
+            var pending = null;
+            mf.addEventListener('input',(ev) => {
+                // Trailing debounce: one kernel round-trip per typing burst
+                clearTimeout(pending);
+                pending = setTimeout(() => {
+                    pending = null;
+                    IPython.notebook.kernel.execute(
+                        "__import__('sys').modules['""" + __name__ + """']._dispatch('$identifier', "
+                        + JSON.stringify(mf.value) + ")");
+                }, 150);
+            });
+            mf.setOptions({
+                virtualKeyboardMode: "manual",
+                virtualKeyboards: "",
+                smartFence: false,
+                removeExtraneousParentheses: true
+            });
+        });
+     </script>
+    """)
+
+
+class _SymbolMap(dict):
+    """Forward symbol map keeping its inverse ``inv`` in sync, like the former bidict."""
+
+    def __init__(self, inv):
+        super().__init__()
+        self.inv = inv
+
+    def __setitem__(self, key, value):
+        if self.inv.get(value, key) != key:
+            raise ValueError(f"{value!r} is already bound to {self.inv[value]!r}")
+        if key in self:
+            del self.inv[self[key]]
+        super().__setitem__(key, value)
+        self.inv[value] = key
+
+    def __delitem__(self, key):
+        del self.inv[self[key]]
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            del self.inv[self[key]]
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        del self.inv[value]
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self.inv.clear()
 
 
 class FormulaParser:
-    symbol_names = {'rho': r'\rho'}
+    __slots__ = ('expr', '_lt', '_sym_inv', '_sym_fwd', '_name_idx',
+                 'mathfield_identifier', '_latex_cache_key', '_comm',
+                 '__weakref__')
+    symbol_names = MappingProxyType({'rho': r'\rho'})
 
     def __init__(self):
         self.expr = None
         self._lt = None
-        self.sym_dct = bidict()
-        self.iter = self.expr_subs()
-        self.mathfield_initialized = False
+        self._sym_inv = {}
+        self._sym_fwd = _SymbolMap(self._sym_inv)
+        self._name_idx = 0
         self.mathfield_identifier = None
+        self._latex_cache_key = None
+        self._comm = None
 
-    def _initialize_mathfield_jupyter(self, globals=globals()):
-        _html = """
-            <script type="module">
-                if (window.mathlive == undefined){
-                    import('https://unpkg.com/mathlive?module').then((mathlive) => {
-                        // Create Keyboard
-                        mathlive.makeSharedVirtualKeyboard({
-                          virtualKeyboardLayout: 'dvorak',
-                        });
-                        window.mathlive = mathlive;
-                        IPython.notebook.kernel.execute("matlive_loaded=True");
-                    });
-
-                    var link = document.createElement('link');
-                    link.type = 'text/css';
-                    link.rel = 'stylesheet';
-                    link.href = 'https://unpkg.com/mathlive/dist/mathlive-static.css';
-                    document.head.appendChild(link);
-
-                    var style = document.createElement('style')
-                    style.innerHTML = " \
-                        .formula{ \
-                            font-size: 1.728em \
-                         } \
-                    "
-                    document.head.appendChild(style);
-                }
-            </script>
-        """
-        display(HTML(_html))
+    def _initialize_mathfield_jupyter(self, globals=None):
+        # globals is accepted for backwards compatibility, callbacks live in _callbacks
         if self.mathfield_identifier is None:
-            while self.mathfield_identifier is None or self.mathfield_identifier in globals:
-                self.mathfield_identifier = "cb_" + ''.join(random.sample(string.ascii_lowercase, 8))
-        globals[self.mathfield_identifier] = lambda x, _self=self: _self.fromLatex(x)
-        self.mathfield_initialized = True
+            self.mathfield_identifier = f"cb_{next(_mf_counter):08x}"
+        _callbacks[self.mathfield_identifier] = weakref.WeakMethod(
+            self._handle_latex_update, lambda _, i=self.mathfield_identifier: _release_editor(i))
+
+    @property
+    def mathfield_initialized(self):
+        return self.mathfield_identifier is not None
 
     def expr_subs(self, start="a", stop="z", step=1, ntimes=True):
         """Yield a range of lowercase letters."""
-        level = 0
-        prefix = ""
-        while True:
-            if level > 0 and ntimes:
-                for prefix in self.expr_subs():
-                    for ord_ in range(ord(start.lower()), ord(stop.lower()) + 1, step):
-                        yield prefix + chr(ord_)
-            else:
-                for ord_ in range(ord(start.lower()), ord(stop.lower()) + 1, step):
-                    yield prefix + chr(ord_)
-            level += 1
+        letters = [chr(ord_) for ord_ in range(ord(start.lower()), ord(stop.lower()) + 1, step)]
+        if not ntimes:
+            while True:
+                yield from letters
+        yield from letters
+        for i in itertools.count():
+            prefix = self._gen_name(i)
+            for letter in letters:
+                yield prefix + letter
+
+    @staticmethod
+    def _gen_name(i):
+        """Return the i-th name of the sequence a, ..., z, aa, ab, ..."""
+        s = ''
+        i += 1
+        while i:
+            i, r = divmod(i - 1, 26)
+            s = chr(ord('a') + r) + s
+        return s
+
+    def _next_name(self):
+        name = self._gen_name(self._name_idx)
+        self._name_idx += 1
+        return name
+
+    @property
+    def sym_dct(self):
+        return self._sym_fwd
+
+    @sym_dct.setter
+    def sym_dct(self, mapping):
+        mapping = dict(mapping)    # may be the map itself, e.g. after ``p.sym_dct |= ...``
+        self._sym_fwd.clear()
+        self._sym_fwd.update(mapping)
 
     def setExpr(self, expr):
         self.expr = expr
-        self._lt = self.toLatex()
-        if self.mathfield_initialized:
-            _html = "document.getElementById('formula_{0}')\
-                        .setValue(ev.target.value,{{suppressChangeNotifications: true}});".format(self.mathfield_identifier)
-            display(HTML(_html))
+        self._latex_cache_key = None
+        self._lt = None
+        self._sync_editor()
+
+    def _sync_editor(self):
+        if self._comm is not None:
+            self._comm.send({'value': self.toLatex()})
 
     def cleanLatex(self, latx):
-        latx = latx.replace("\exponentialE", "e")
-        latx = latx.replace("\differentialD", "\d")
-        return latx
+        if '\\' not in latx:
+            return latx
+        return _clean_latex_cached(latx)
 
     def fromLatex(self, latx):
+        self._apply_latex(self.cleanLatex(latx))
+        self._sync_editor()
+        return self
+
+    def _apply_latex(self, latx):
+        self.expr = _parse_latex_cached(latx)
+        # keep the user's formatting instead of the printer's round-trip
+        self._keep_latex(latx)
+
+    def _keep_latex(self, latx):
+        self._lt = _intern_latex(latx)
+        self._latex_cache_key = self.expr
+
+    def _handle_latex_update(self, latx):
+        # the editor echoes values we already hold, skip the reparse for those
         latx = self.cleanLatex(latx)
-        self._lt = latx
-        self.setExpr(parse_latex(latx))
+        if not latx or latx == self._lt:
+            return self
+        # the value came from the editor, so there is nothing to push back
+        self._apply_latex(latx)
         return self
 
     def toLatex(self):
-        return sympy.latex(self.expr, symbol_names=self.symbol_names)
+        if self._lt is not None and self._latex_cache_key is self.expr:
+            return self._lt
+        if not isinstance(self.expr, Hashable):
+            # mutable matrices can change in place, so neither memoize nor keep the result
+            return _intern_latex(sympy.latex(self.expr, symbol_names=self.symbol_names))
+        self._lt = _latex_for(self.expr, tuple(self.symbol_names.items()))
+        self._latex_cache_key = self.expr
+        return self._lt
 
     def toSage(self):
         expr = self.expr
-        for a in expr.atoms(Symbol):
-            self.sym_dct[a] = Symbol(next(self.iter))
-            expr = expr.subs(a, self.sym_dct[a])
-        return expr._sage_()
+        # bound variables keep their names, a free symbol renamed onto one would be captured
+        taken = {s.name for s in expr.atoms(Symbol)}
+        mapping = {}
+        for a in expr.free_symbols:
+            name = self._next_name()
+            while name in taken or Symbol(name) in self._sym_inv:    # still bound after a load
+                name = self._next_name()
+            mapping[a] = Symbol(name)
+        self._sym_fwd.update(mapping)
+        return expr.xreplace(mapping)._sage_()
 
     def fromSage(self, sage):
         expr = sage._sympy_()
-        for a in expr.atoms(Symbol):
-            expr = expr.subs(a, self.sym_dct.inv[a])
-        self.setExpr(self.expr)
+        self.setExpr(expr.xreplace({a: self._sym_inv[a] for a in expr.free_symbols if a in self._sym_inv}))
         return self
 
     def toSympy(self):
@@ -114,58 +396,55 @@ class FormulaParser:
         self.setExpr(expr)
         return self
 
-    def editor(self, globals=globals()):
+    def editor(self, globals=None):
+        from IPython.display import HTML, display
         self._initialize_mathfield_jupyter(globals=globals)
-        _html = """
-        <label>Math-Editor</label>
-        <math-field use-shared-virtual-keyboard id="formula_{0}" class="formula">
-            {1}
-        </math-field>
-        <script type="module">
-            function _render_matlive(){{
-                if(window.mathlive){{
-                    console.log("Matlive observer {0} started!")
-                    mathlive.renderMathInDocument()
-                    var mf = document.getElementById('formula_{0}');
-                    mf.addEventListener('input',(ev) => {{
-                        IPython.notebook.kernel.execute("{0}(r'"+mf.value+"')");
-                    }});     
-                    mf.setOptions({{
-                        virtualKeyboardMode: "manual",
-                        virtualKeyboards: "",
-                        smartFence: false,
-                        removeExtraneousParentheses: true
-                    }});
-                }}else{{
-                    setTimeout(function(){{_render_matlive()}},100);
-                }}
-            }}
-            _render_matlive();
-         </script>
-        """.format(self.mathfield_identifier, self.toLatex())
-        display(HTML(_html))
+        display(HTML(_EDITOR_TEMPLATE.substitute(identifier=self.mathfield_identifier,
+                                                  initial_latex=self.toLatex())))
+        if self._comm is None:
+            # opened after the markup, which registers the frontend target
+            self._comm = _open_comm(self.mathfield_identifier)
 
     def subs(self, dct: dict):
-        for n, v in dct.items():
-            self.expr = self.expr.subs(n, v)
-        self.setExpr(self.expr)
+        self.setExpr(self.expr.subs(list(dct.items())))
         return self
 
     def isEmpty(self):
-        return self.expr == None
+        return self.expr is None
 
     def load(self, obj):
-        self.sym_dct = bidict(obj["sym_dct"])
-        self._lt = obj["lt"]
-        if self._lt is not None:
+        self._sym_fwd.clear()
+        for a, b in obj["sym_dct"].items():
+            self._sym_fwd[_from_srepr(a)] = _from_srepr(b)
+        if obj.get("expr_srepr") is not None:
+            self.setExpr(_from_srepr(obj["expr_srepr"]))
+            if obj["lt"] is not None:
+                self._keep_latex(obj["lt"])
+        elif obj["lt"] is not None:
             self.fromLatex(obj["lt"])
         return self
 
     def export(self):
-        return {"expr": str(self.expr), "sym_dct": dict(self.sym_dct), "lt": self._lt}
+        empty = self.expr is None
+        return {"expr": str(self.expr),
+                "expr_srepr": None if empty else sympy.srepr(self.expr),
+                "sym_dct": {sympy.srepr(a): sympy.srepr(b) for a, b in self._sym_fwd.items()},
+                "lt": None if empty else self.toLatex()}
 
     def _repr_latex_(self):
-        try:
-            return '$ {\large ' + self.toLatex() + '}$'
-        except AttributeError:
+        if self.expr is None:
             return None    # if None is returned, plain text is used
+        return f'$ {{\\large {self.toLatex()}}}$'
+
+
+if __name__ == "__main__":
+    x = Symbol("x")
+    for e in [sympy.Integral(sympy.exp(-x**2), (x, -sympy.oo, sympy.oo)),
+              sympy.Limit(1 / x, x, -sympy.oo),
+              sympy.Piecewise((x, x > 0), (-x, True)),
+              sympy.Integral(x * Symbol("y"), (x, 0, 1)),
+              sympy.ImmutableMatrix([[1, x], [-x, 2]]),
+              sympy.Matrix([[1, x]]),
+              sympy.Add(sympy.Mul(2, 3, evaluate=False), x, evaluate=False)]:
+        loaded = FormulaParser().load(FormulaParser().fromSympy(e).export())
+        assert sympy.srepr(loaded.expr) == sympy.srepr(e), (e, loaded.expr)
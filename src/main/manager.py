@@ -1,9 +1,28 @@
+import os
 import json
+import importlib.util
 from dotmap import DotMap
-from easyMathSolver.jupyter.formulas import FormulaParser
-from sympy.parsing.latex._build_latex_antlr import build_parser
 
-build_parser()
+_FormulaParser = None
+
+
+def _formula_parser():
+    global _FormulaParser
+    if _FormulaParser is None:
+        # Regenerating the ANTLR parser is slow, only do it when it is missing or requested.
+        if os.environ.get("EASYMATH_REBUILD_PARSER") == "1" \
+                or importlib.util.find_spec("sympy.parsing.latex._antlr.latexparser") is None:
+            from sympy.parsing.latex._build_latex_antlr import build_parser
+            build_parser()
+        from easyMathSolver.jupyter.formulas import FormulaParser as _FormulaParser
+    return _FormulaParser
+
+
+def __getattr__(name):
+    # keeps ``from easyMathSolver.main.manager import FormulaParser`` working, importing it lazily
+    if name == "FormulaParser":
+        return _formula_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class FormulaManager(DotMap):
@@ -12,12 +31,12 @@ class FormulaManager(DotMap):
         super().__init__(_dynamic=False)
 
     def add(self, name):
-        self[name] = FormulaParser()
+        self[name] = _formula_parser()()
         return self[name]
 
     def get(self, name):
         if name not in self:
-            self[name] = FormulaParser()
+            self[name] = _formula_parser()()
         return self[name]
 
     def remove(self, name):
@@ -28,27 +47,25 @@ class FormulaManager(DotMap):
         with open(path, "r") as f:
             self.clear()
             for n, v in json.load(f).items():
-                self[n] = FormulaParser().load(v)
+                self[n] = _formula_parser()().load(v)
         return self
 
     def save(self, path):
         with open(path, "w") as f:
-            f.write(json.dumps({n: v.export() for n, v in self.items()}))
+            json.dump({n: v.export() for n, v in self.items()}, f)
         return self
 
     def cleanEmpty(self):
-        for name, formula in list(self.items()):
-            if formula.isEmpty():
-                self.items.pop(name)
+        for name in [n for n, f in self.items() if f.isEmpty()]:
+            del self[name]
         return self
 
     @staticmethod
     def latexSymbol(expr):
-        return FormulaParser().fromLatex(expr).toSympy()
+        return _formula_parser()().fromLatex(expr).toSympy()
 
 
 if __name__ == "__main__":
-    import os
     fm = FormulaManager()
     fm.add("Test").fromLatex("x^n + y^n = z^n")
     fm.save("Test.json")
@@ -1,8 +1,15 @@
+import functools
 from sympy import Eq
 from sympy.utilities.lambdify import lambdify
 from sympy.core.function import AppliedUndef
 
 
+@functools.lru_cache(maxsize=512)
+def _lambdify_cached(eq):
+    _args = eq.lhs.args
+    return _args, lambdify(_args, eq.rhs)
+
+
 class CalcToolbox:
 
     @classmethod
@@ -11,13 +18,19 @@ class CalcToolbox:
             eq = [cls.match_eq(_e, eq[-1]) for _e in eq[:-1]]
         _eq0 = eq0.rhs if hasattr(eq0, "rhs") else eq0
 
-        for _i, _part in enumerate(_eq0.args):
+        _targets = tuple({type(_eq.lhs) for _eq in eq})
+        # applied one at a time so functions inserted by a replacement are
+        # expanded by the replacements of the following arguments
+        for _part in _eq0.args:
             if isinstance(_part, AppliedUndef):
                 for _eq in eq:
                     if type(_part) == type(_eq.lhs):
-                        _eq0 = _eq0.subs(_part, _eq.rhs.subs(dict(zip(_eq.lhs.args, _part.args))))
-            else:
-                _eq0 = _eq0.subs(_part, cls.match_eq(_part, *eq, deep=False))
+                        _eq0 = _eq0.xreplace({_part: _eq.rhs.xreplace(dict(zip(_eq.lhs.args, _part.args)))})
+                        break
+            elif _part.has(*_targets):
+                _new = cls.match_eq(_part, *eq, deep=False)
+                if _new is not _part:
+                    _eq0 = _eq0.xreplace({_part: _new})
 
         if hasattr(eq0, "rhs"):
             _eq0 = Eq(eq0.lhs, _eq0)
@@ -26,5 +39,4 @@ class CalcToolbox:
        
     @classmethod
     def lambidifyEq(cls, eq):
-        _args = eq.lhs.args
-        return _args, lambdify(_args, eq.rhs)
+        return _lambdify_cached(eq)